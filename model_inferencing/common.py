@@ -0,0 +1,302 @@
+import torch
+import time
+import typing
+import numpy as np
+from torch import device, Tensor
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.models.gpt2.tokenization_gpt2_fast import GPT2TokenizerFast
+from transformers.models.gpt2.modeling_gpt2 import GPT2LMHeadModel
+
+
+@contextmanager
+def track_time() -> typing.Generator[None, None, None]:
+    """Tracks the time taken to inference from a batch of inputs.
+
+    Parameters
+    ----------
+
+    Yield
+    -----
+    Generator[None, None, None]
+        Generator used to track the time of inference"""
+    start = time.time()
+    yield
+    end = time.time()
+    print(f"Execution time: {end - start:.2f}s")
+
+
+@lru_cache(maxsize=None)
+def load_model(
+    model_name: str, avaible_device: device, half_precision: bool = False
+) -> GPT2LMHeadModel:
+    """Loads the model in inference mode, reusing the same instance across benchmarks.
+
+    Parameters
+    ----------
+    model_name: str
+        Name or path of the pretrained model to be loaded.
+    avaible_device: device
+        Device (CPU or GPU) on which the model's predictions will be performed.
+    half_precision: bool=False
+        Whether to cast the model to FP16, which halves memory bandwidth on GPU.
+
+    Return
+    ------
+    GPT2LMHeadModel
+        Model ready to be used for inference.
+    """
+
+    model: GPT2LMHeadModel = AutoModelForCausalLM.from_pretrained(model_name).to(
+        avaible_device
+    )
+    if half_precision and avaible_device.type == "cuda":
+        model = model.half()
+    model.eval()
+    return model
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(tokenizer_name: str) -> GPT2TokenizerFast:
+    """Loads the tokenizer once, reusing the same instance across benchmarks.
+
+    Parameters
+    ----------
+    tokenizer_name: str
+        Name or path of the pretrained tokenizer to be loaded.
+
+    Return
+    ------
+    GPT2TokenizerFast
+        Tokenizer with left padding and the eos token defined as padding token.
+    """
+
+    # Left padding because gpt2 based models are autoregressive, and by default they
+    # do not define a padding token
+    tokenizer: GPT2TokenizerFast = AutoTokenizer.from_pretrained(
+        tokenizer_name, padding_side="left"
+    )
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def batch_generate(
+    tokens: Tensor,
+    tokenizer: GPT2TokenizerFast,
+    model: GPT2LMHeadModel,
+    use_beam: bool = False,
+) -> Tensor:
+    """Generate predictions from tokenized inputs, treated as batches.
+
+    Parameters
+    ----------
+    tokens: Tensor
+        Tokenized inputs to be treated as batches and inferenced from.
+    tokenizer: GPT2TokenizerFast
+        Tokenizer which will be used to tokenize the string input into tokenized indexed values.
+    model: GPT2LMHeadModel
+        Model which will be used for inference.
+    use_beam: bool=False
+        Whether to use beam search instead of greedy search. Beam search doubles the
+        effective batch dimension per step, so it is disabled for throughput-oriented runs.
+
+    Return
+    ------
+    Tensor
+        Generated token ids; decoding is deferred to the caller so all outputs can be
+        decoded in a single batch_decode call.
+    """
+
+    # max_length method is the sum of the input length + output length
+    # max_new_tokens is the sum of the output length
+    if tokens.ndim == 1:
+        print(f"Shape of tokens before unsqueeze: {tokens.shape}")
+
+        # Add a dimension at the beginning to make it a 2D tensor
+        tokens = tokens.unsqueeze(0)
+
+    with torch.no_grad():
+        print(f"Shape of tokens: {tokens.shape}")
+        # Autocast runs the decoder layers in mixed precision on GPU; it is disabled on CPU,
+        # where the model stays in FP32
+        with torch.autocast(
+            device_type=tokens.device.type,
+            dtype=torch.float16,
+            enabled=tokens.device.type == "cuda",
+        ):
+            # num_beams mirrors the beam_size used by the quantized model in order to keep executions comparable
+            # max_new_tokens caps only the generated tokens, so short prompts are not decoded up to a fixed total length
+            outputs = model.generate(
+                tokens,
+                max_new_tokens=64,
+                pad_token_id=tokenizer.eos_token_id,
+                num_beams=2 if use_beam else 1,
+                do_sample=False,
+                use_cache=True,
+            )
+
+    return outputs
+
+
+def iter_token_batches(
+    tokenized_inputs: list[list[int]], token_budget: int, max_rows: int
+) -> typing.Generator[list[list[int]], None, None]:
+    """Groups tokenized inputs of the same length into batches bounded by the token budget.
+
+    Parameters
+    ----------
+    tokenized_inputs: list[list[int]]
+        Tokenized inputs to be bucketed by length and grouped into batches.
+    token_budget: int
+        Maximun amount of tokens to be processed within the same batch.
+    max_rows: int
+        Maximun amount of inputs in each batch, to avoid memory overflow on short sequences.
+
+    Yield
+    ------
+    Generator[list[list[int]], None, None]
+        Batch of tokenized inputs sharing the same length.
+    """
+
+    # Length bucketing is vectorized with NumPy so the sort and the bucket boundaries
+    # are computed at C speed instead of through a Python sort plus dict build
+    lengths = np.fromiter(
+        map(len, tokenized_inputs), dtype=np.int32, count=len(tokenized_inputs)
+    )
+    order = np.argsort(lengths, kind="stable")
+    # Empty tokenizations are dropped before bucketing
+    order = order[lengths[order] > 0]
+    unique_lengths, boundaries = np.unique(lengths[order], return_index=True)
+    boundaries = np.append(boundaries, len(order))
+
+    for length, bucket_start, bucket_end in zip(
+        unique_lengths, boundaries[:-1], boundaries[1:]
+    ):
+        length = int(length)
+        sorted_batch = [tokenized_inputs[i] for i in order[bucket_start:bucket_end]]
+        print("length:", length)
+        current_batch = []
+        for batch in sorted_batch:
+            # The batch is flushed once the token budget is reached, so each forward pass
+            # processes as many same-length inputs as the avaible_device can hold
+            if current_batch and (
+                (len(current_batch) + 1) * length > token_budget
+                or len(current_batch) >= max_rows
+            ):
+                print("Tamanho em tokens:", len(current_batch) * length)
+                yield current_batch
+                current_batch = []
+
+            current_batch.append(batch)
+
+        if current_batch:
+            yield current_batch
+
+
+def copy_batch_to_device(
+    current_batch: list[list[int]],
+    avaible_device: device,
+    copy_stream: typing.Optional["torch.cuda.Stream"] = None,
+) -> Tensor:
+    """Builds the batch tensor and copies it to the avaible_device.
+
+    Parameters
+    ----------
+    current_batch: list[list[int]]
+        Tokenized inputs of the same length to be turned into a single batch tensor.
+    avaible_device: device
+        Device (CPU or GPU) to which the batch tensor will be copied.
+    copy_stream: typing.Optional[torch.cuda.Stream]=None
+        Dedicated CUDA stream used for the copy, so the transfer overlaps with the
+        generation of the previous batch.
+
+    Return
+    ------
+    Tensor
+        Batch tensor placed on the avaible_device.
+    """
+
+    # All rows share the same length within a bucket, so NumPy can fill a (rows, length)
+    # int64 buffer directly instead of torch.tensor introspecting the nested lists
+    batch_array = np.asarray(current_batch, dtype=np.int64)
+
+    if avaible_device.type != "cuda":
+        return torch.from_numpy(batch_array)
+
+    # Pinned memory allows an asynchronous host to device copy instead of a synchronous one
+    cpu_batch = torch.from_numpy(batch_array).pin_memory()
+    with torch.cuda.stream(copy_stream):
+        tensor_batch = cpu_batch.to(avaible_device, non_blocking=True)
+
+    # The compute stream waits for the copy before the model consumes the tensor
+    torch.cuda.current_stream().wait_stream(copy_stream)
+    return tensor_batch
+
+
+def predict_sorted_batches(
+    prompts: list[str],
+    tokenizer: GPT2TokenizerFast,
+    model: GPT2LMHeadModel,
+    avaible_device: device,
+    pretokenized: typing.Optional[list[list[int]]] = None,
+    token_budget: int = 4096,
+    max_rows: int = 64,
+    max_length: int = 128,
+) -> typing.Generator[Tensor, None, str]:
+    """Applies sorting and dynamic batching techniques to inference from inputs.
+
+    Parameters
+    ----------
+    prompts: list[str]
+        List of inputs to be treated as batches and inferenced from.
+    tokenizer: GPT2TokenizerFast
+        Tokenizer which will be used to tokenize the string input into tokenized indexed values.
+    model: GPT2LMHeadModel
+        Model which will be used for inference.
+    avaible_device: device
+        Device (CPU or GPU) on which the model's predictions and tokenization will be performed.
+    pretokenized: typing.Optional[list[list[int]]]=None
+        Already tokenized prompts, so the same tokenization can be shared between benchmark paths.
+    token_budget: int=4096
+        Maximun amount of tokens to be processed within the same batch.
+    max_rows: int=64
+        Maximun amount of inputs in each batch, to avoid memory overflow on short sequences.
+    max_length: int=128
+        Maximun amount of tokens kept per prompt when the inputs are not pretokenized.
+
+    Yield
+    ------
+    Generator[Tensor, None, str]
+        Generated token ids for each batch, decoded once by the caller.
+    """
+
+    # Tensor format is removed because tensors require inputs of the same length
+    if pretokenized is not None:
+        tokenized_inputs = pretokenized
+    else:
+        tokenized_inputs = tokenizer(
+            prompts, padding=False, truncation=True, max_length=max_length
+        )["input_ids"]
+
+    copy_stream = torch.cuda.Stream() if avaible_device.type == "cuda" else None
+
+    # The next batch tensor is built and copied on a background thread while the current
+    # batch is generating; pinned copies release the GIL, so the prefetch overlaps with
+    # the generation step that dominates the wall clock (1-deep prefetch queue)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for current_batch in iter_token_batches(
+            tokenized_inputs, token_budget, max_rows
+        ):
+            submitted = executor.submit(
+                copy_batch_to_device, current_batch, avaible_device, copy_stream
+            )
+            if pending is not None:
+                yield batch_generate(pending.result(), tokenizer, model)
+
+            pending = submitted
+
+        if pending is not None:
+            yield batch_generate(pending.result(), tokenizer, model)
@@ -1,6 +1,8 @@
 import torch
 import time
 import random
+import numpy as np
+from collections import defaultdict
 from torch import device, cuda, Tensor
 from tqdm.auto import tqdm
 from contextlib import contextmanager
@@ -96,16 +98,14 @@ def predict_sorted_batches(
     )["input_ids"]
 
     sorted_tokens = sorted(tokenized_inputs, key=len)
-    sorted_batches: dict[int, list[list[int]]] = {}
+    # defaultdict drops the membership check and the bucket initialization branch per input;
+    # insertion order follows the sorted tokens, so iteration stays ordered by length
+    sorted_batches: defaultdict[int, list[list[int]]] = defaultdict(list)
     for sorted_token in sorted_tokens:
         if not len(sorted_token):
             continue
 
-        length = len(sorted_token)
-        if length not in sorted_batches:
-            sorted_batches[length] = []
-
-        sorted_batches[length].append(sorted_token)
+        sorted_batches[len(sorted_token)].append(sorted_token)
     max_size = max(sorted_batches.keys())
 
     for length, sorted_batch in sorted_batches.items():
@@ -115,19 +115,25 @@ def predict_sorted_batches(
         for batch in sorted_batch:
             if current_batch_size + len(batch) > max_size:
                 print("Tamanho em tokens:", current_batch_size)
-                tensor_batch = torch.tensor(current_batch).to(avaible_device)
+                # The tensor is not deleted explicitly: PyTorch's caching allocator reuses
+                # the memory once the reference goes out of scope.
+                # All rows share the same length, so NumPy fills the buffer directly
+                # instead of torch.tensor introspecting the nested lists
+                tensor_batch = torch.from_numpy(
+                    np.asarray(current_batch, dtype=np.int64)
+                ).to(avaible_device)
                 print("Length of each input in this batch", length)
                 yield batch_generate(tensor_batch, tokenizer, model)
-                del tensor_batch
                 current_batch, current_batch_size = [], 0
 
             current_batch.append(batch)
             current_batch_size += len(batch)
 
         if current_batch:
-            tensor_batch = torch.tensor(current_batch).to(avaible_device)
+            tensor_batch = torch.from_numpy(
+                np.asarray(current_batch, dtype=np.int64)
+            ).to(avaible_device)
             yield batch_generate(tensor_batch, tokenizer, model)
-            del tensor_batch
 
     return "All batches have been processed."
 
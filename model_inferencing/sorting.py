@@ -1,31 +1,13 @@
 import torch
-import time
 import random
+import numpy as np
 from torch import device, cuda, Tensor
 from tqdm.auto import tqdm
-from contextlib import contextmanager
-from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers.models.gpt2.modeling_gpt2 import GPT2LMHeadModel
 from transformers.models.gpt2.tokenization_gpt2_fast import GPT2TokenizerFast
 from datasets import load_dataset
 from typing import Generator
-
-
-@contextmanager
-def track_time() -> Generator[None, None, None]:
-    """Tracks the time taken to inference from a batch of inputs.
-
-    Parameters
-    ----------
-
-    Yield
-    -----
-    Generator[None, None, None]
-        Generator used to track the time of inference"""
-    start = time.time()
-    yield
-    end = time.time()
-    print(f"Execution time: {end - start:.2f}s")
+from common import track_time, batch_generate, load_model, load_tokenizer
 
 
 # Normal batching
@@ -50,42 +32,6 @@ def chunker(
     return (seq[pos : pos + max_size] for pos in range(0, len(seq), max_size))
 
 
-def batch_generate(
-    tokens: Tensor, tokenizer: GPT2TokenizerFast, model: GPT2LMHeadModel
-) -> list[str]:
-    """Generate predictions from tokenized inputs, treated as batches.
-
-    Parameters
-    ----------
-    tokens: Tensor
-        Tokenized inputs to be treated as batches and inferenced from.
-    tokenizer: GPT2TokenizerFast
-        Tokenizer which will be used to tokenize the string input into tokenized indexed values.
-    model: GPT2LMHeadModel
-        Model which will be used for inference.
-
-    Return
-    ------
-    list[str]
-        Response generated by the model.
-    """
-
-    # max_length method is the sum of the input length + output length
-    # max_new_tokens is the sum of the output length
-    if tokens.ndim == 1:
-        print(f"Shape of tokens before unsqueeze: {tokens.shape}")
-
-        # Add a dimension at the beginning to make it a 2D tensor
-        tokens = tokens.unsqueeze(0)
-
-    with torch.no_grad():
-        outputs = model.generate(
-            tokens, max_new_tokens=64, pad_token_id=tokenizer.eos_token_id
-        )
-
-    return tokenizer.batch_decode(outputs, skip_special_tokens=True)
-
-
 # Sorted batching
 def predict_sorted_batches(
     prompts: list[str],
@@ -93,7 +39,7 @@ def predict_sorted_batches(
     tokenizer: GPT2TokenizerFast,
     model: GPT2LMHeadModel,
     avaible_device: device,
-) -> Generator[list[str], None, str]:
+) -> Generator[Tensor, None, str]:
     """Applies sorting batching technique to inference from inputs.
 
     Parameters
@@ -111,8 +57,8 @@ def predict_sorted_batches(
 
     Yield
     ------
-    Generator[list[str], None, str]
-        Response generated by the model.
+    Generator[Tensor, None, str]
+        Generated token ids for each batch, decoded once by the caller.
     """
 
     # Tensor format is removed because tensors require inputs of the same length (It is removed because padding is disabled)
@@ -120,39 +66,44 @@ def predict_sorted_batches(
         prompts, padding=False, truncation=True, max_length=512
     )["input_ids"]
 
-    sorted_tokens = sorted(tokenized_inputs, key=len)
-    sorted_batches: dict[int, list[list[int]]] = {}
-    for sorted_token in sorted_tokens:
-        if not len(sorted_token):
-            continue
-
-        length = len(sorted_token)
-        if length not in sorted_batches:
-            sorted_batches[length] = []
-
-        sorted_batches[length].append(sorted_token)
-
-    for length, sorted_batch in sorted_batches.items():
+    # Length bucketing is vectorized with NumPy so the sort and the bucket boundaries
+    # are computed at C speed instead of through a Python sort plus dict build
+    lengths = np.fromiter(
+        map(len, tokenized_inputs), dtype=np.int32, count=len(tokenized_inputs)
+    )
+    order = np.argsort(lengths, kind="stable")
+    # Empty tokenizations are dropped before bucketing
+    order = order[lengths[order] > 0]
+    unique_lengths, boundaries = np.unique(lengths[order], return_index=True)
+    boundaries = np.append(boundaries, len(order))
+
+    for length, bucket_start, bucket_end in zip(
+        unique_lengths, boundaries[:-1], boundaries[1:]
+    ):
+        length = int(length)
+        sorted_batch = [tokenized_inputs[i] for i in order[bucket_start:bucket_end]]
         for batch in chunker(sorted_batch, max_batch_size):
-            tensor_batch = torch.tensor(batch).to(avaible_device)
+            # The tensor is not deleted explicitly: PyTorch's caching allocator reuses the
+            # memory once the reference goes out of scope.
+            # All rows share the same length, so NumPy fills the buffer directly
+            # instead of torch.tensor introspecting the nested lists
+            tensor_batch = torch.from_numpy(np.asarray(batch, dtype=np.int64)).to(
+                avaible_device
+            )
             print("Length of each input in this batch", length)
             yield batch_generate(tensor_batch, tokenizer, model)
-            del tensor_batch
 
     return "All batches have been processed."
 
 
 def main():
     avaible_device = device("cuda" if cuda.is_available() else "cpu")
-    model: GPT2LMHeadModel = AutoModelForCausalLM.from_pretrained(
-        "TheFuzzyScientist/diabloGPT_open-instruct"
-    ).to(avaible_device)
-    model.eval()
-
-    tokenizer: GPT2TokenizerFast = AutoTokenizer.from_pretrained(
-        "microsoft/DialoGPT-medium", padding_side="left"
+    # The cached loaders reuse the same model and tokenizer instances when several
+    # benchmark scripts run back-to-back in the same process
+    model: GPT2LMHeadModel = load_model(
+        "TheFuzzyScientist/diabloGPT_open-instruct", avaible_device
     )
-    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer: GPT2TokenizerFast = load_tokenizer("microsoft/DialoGPT-medium")
 
     dataset = load_dataset("hakurei/open-instruct-v1", split="train")
     example_prompts = dataset["instruction"][-4:]
@@ -177,12 +128,18 @@ def main():
         generator = predict_sorted_batches(
             example_prompts_4_sorting_prediction, 32, tokenizer, model, avaible_device
         )
+        all_output_ids: list[list[int]] = []
         try:
-            for batch_prediction in tqdm(generator):
-                print("Amount of inputs in this batch:", len(batch_prediction))
+            for batch_output_ids in tqdm(generator):
+                print("Amount of inputs in this batch:", len(batch_output_ids))
+                all_output_ids.extend(batch_output_ids.tolist())
         except StopIteration as e:
             print(f"Generator returned: {e.value}")
 
+        # One batch_decode call at the end amortizes the Rust tokenizer parallelism
+        # over all outputs instead of paying one crossing per batch
+        tokenizer.batch_decode(all_output_ids, skip_special_tokens=True)
+
 
 if __name__ == "__main__":
     main()